@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
 import errno
-import io
+import functools
+import json
 import os
 import shutil
 import stat
 import subprocess
 import sys
+import threading
 from os.path import dirname, exists, expandvars
+from typing import Optional
 
 
 def norm(p: str) -> str:
@@ -21,18 +23,40 @@ def join(b: str, p: str) -> str:
 
 
 def mkdir(p: str) -> None:
-    if not exists(p):
-        os.makedirs(p)
+    os.makedirs(p, exist_ok=True)
 
 
 def rmdir(p: str) -> None:
+    try:
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(p, onexc=_handle_read_only)
+        else:
+            # onerror passes sys.exc_info() instead of the exception.
+            shutil.rmtree(p, onerror=lambda f, p, e: _handle_read_only(f, p, e[1]))
+    except FileNotFoundError:
+        pass
+
+
+def rmdir_in_background(p: str) -> None:
+    """Move p out of the way at once and delete it on a background thread.
+
+    The thread isn't a daemon, so the interpreter waits for the delete to
+    finish before exiting.
+    """
     if not exists(p):
         return
-    shutil.rmtree(p, onerror=_handle_read_only)
-
-
-def _handle_read_only(f, p, e):
-    if f in (os.rmdir, os.remove, os.unlink) and e[1].errno == errno.EACCES:
+    old_dir = p + ".old"
+    # Left behind when a previous run exited before the delete finished.
+    rmdir(old_dir)
+    os.rename(p, old_dir)
+    threading.Thread(target=rmdir, args=(old_dir,)).start()
+
+
+def _handle_read_only(f, p, e: BaseException):
+    if (
+        f in (os.rmdir, os.remove, os.unlink)
+        and getattr(e, "errno", None) == errno.EACCES
+    ):
         os.chmod(p, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
         f(p)
     else:
@@ -47,6 +71,34 @@ LLVM_INSTALL_DIR = join(BUILD_DIR, "../out/llvm-install")
 LIBCXX_BUILD_DIR = join(BUILD_DIR, "../out/libcxx-build")
 LIBCXX_INSTALL_DIR = join(BUILD_DIR, "../out/libcxx-install")
 
+# Build libc++ with the toolchain from build.py.
+if sys.platform == "win32":
+    TOOLCHAIN_CMAKE_ARGS = (
+        "-DCMAKE_C_COMPILER=%s" % join(LLVM_INSTALL_DIR, "bin/clang-cl.exe"),
+        "-DCMAKE_CXX_COMPILER=%s" % join(LLVM_INSTALL_DIR, "bin/clang-cl.exe"),
+        "-DCMAKE_LINKER=%s" % join(LLVM_INSTALL_DIR, "bin/lld-link.exe"),
+        "-DLLVM_ENABLE_RUNTIMES=libcxx",
+    )
+else:
+    TOOLCHAIN_CMAKE_ARGS = (
+        "-DCMAKE_C_COMPILER=%s" % join(LLVM_INSTALL_DIR, "bin/clang"),
+        "-DCMAKE_CXX_COMPILER=%s" % join(LLVM_INSTALL_DIR, "bin/clang++"),
+        "-DCMAKE_LINKER=%s" % join(LLVM_INSTALL_DIR, "bin/lld"),
+        "-DLIBCXXABI_USE_LLVM_UNWINDER=Off",
+        "-DLLVM_ENABLE_RUNTIMES=libcxx;libcxxabi",
+    )
+
+# VS versions are listed in descending order of priority (highest first).
+# The first version is assumed by this script to be the one that is packaged,
+# which makes a difference for the arm64 runtime.
+MSVS_VERSIONS = {
+    "2022": "17.0",  # Default and packaged version of Visual Studio.
+    "2019": "16.0",
+    "2017": "15.0",
+}
+MSVS_INSTALL_ROOTS = ("%ProgramFiles%", "%ProgramFiles(x86)%")
+MSVS_EDITIONS = ("Enterprise", "Professional", "Community", "Preview", "BuildTools")
+
 
 def main() -> int:
     if not exists(LLVM_INSTALL_DIR):
@@ -58,6 +110,25 @@ def main() -> int:
         "--install-dir",
         help="override the install",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=available_cpus() + 2,
+        help="number of parallel ninja jobs (default: usable CPUs + 2)",
+    )
+    parser.add_argument(
+        "--no-ccache",
+        dest="use_ccache",
+        action="store_false",
+        help="Don't use sccache or ccache, even if one is installed",
+    )
+    parser.add_argument(
+        "--clean",
+        action="store_true",
+        help="delete the libc++ build directory first instead of "
+        "reconfiguring it in place",
+    )
 
     args = parser.parse_args()
     libcxx_install_dir = args.install_dir if args.install_dir else LIBCXX_INSTALL_DIR
@@ -65,68 +136,118 @@ def main() -> int:
     cmake_args = [
         "-GNinja",
         "-DCMAKE_BUILD_TYPE=Release",
-        f'-DCMAKE_INSTALL_PREFIX="{libcxx_install_dir}"',
+        f"-DCMAKE_INSTALL_PREFIX={libcxx_install_dir}",
+        *TOOLCHAIN_CMAKE_ARGS,
     ]
 
-    if sys.platform == "win32":
-        cmake_args += [
-            f'-DCMAKE_C_COMPILER="{LLVM_INSTALL_DIR}/bin/clang-cl.exe"',
-            f'-DCMAKE_CXX_COMPILER="{LLVM_INSTALL_DIR}/bin/clang-cl.exe"',
-            f'-DCMAKE_LINKER="{LLVM_INSTALL_DIR}/bin/lld-link.exe"',
-            '-DLLVM_ENABLE_RUNTIMES="libcxx"',
-        ]
-    else:
+    launcher = None
+    if args.use_ccache:
+        launcher = shutil.which("sccache") or shutil.which("ccache")
+    if launcher:
+        # --clean throws the objects away with the build directory; the
+        # compiler cache keeps those of unchanged sources for the rebuild.
         cmake_args += [
-            f'-DCMAKE_C_COMPILER="{LLVM_INSTALL_DIR}/bin/clang"',
-            f'-DCMAKE_CXX_COMPILER="{LLVM_INSTALL_DIR}/bin/clang++"',
-            f'-DCMAKE_LINKER="{LLVM_INSTALL_DIR}/bin/lld"',
-            "-DLIBCXXABI_USE_LLVM_UNWINDER=Off",
-            '-DLLVM_ENABLE_RUNTIMES="libcxx;libcxxabi"',
+            "-DCMAKE_C_COMPILER_LAUNCHER=%s" % launcher,
+            "-DCMAKE_CXX_COMPILER_LAUNCHER=%s" % launcher,
         ]
+        # Make ccache hits independent of where the checkout lives; sccache
+        # ignores these.
+        os.environ.setdefault("CCACHE_BASEDIR", join(BUILD_DIR, ".."))
+        os.environ.setdefault("CCACHE_SLOPPINESS", "pch_defines,time_macros")
 
     deployment_target = "10.15"
     os.environ["MACOSX_DEPLOYMENT_TARGET"] = deployment_target
 
-    rmdir(LIBCXX_BUILD_DIR)
-    rmdir(LIBCXX_INSTALL_DIR)
+    if sys.platform == "win32":
+        # Both commands below inherit this environment, so vcvarsall.bat only
+        # has to run once.
+        load_visual_studio_env()
+
+    # Check for CMake now rather than failing the first configure later.
+    if not shutil.which("cmake"):
+        print("cmake was not found in PATH; install CMake 3.20 or later.")
+        return 1
+    if cmake_version() < (3, 20):
+        print("CMake 3.20 or later is needed to build libc++.")
+        return 1
+
+    # Configure and build while the old trees are being deleted.
+    if args.clean:
+        rmdir_in_background(LIBCXX_BUILD_DIR)
+    rmdir_in_background(LIBCXX_INSTALL_DIR)
 
     mkdir(LIBCXX_BUILD_DIR)
     os.chdir(LIBCXX_BUILD_DIR)
 
-    run_command(
-        ["cmake"] + cmake_args + ['"' + join(LLVM_PROJECT_DIR, "runtimes") + '"']
-    )
-    run_command(["ninja", "install"])
+    # Without --clean the build directory is kept so ninja only rebuilds what
+    # changed.
+    cmake = cmake_command(LIBCXX_BUILD_DIR, fresh=not args.clean)
+    run_command(cmake + cmake_args + [join(LLVM_PROJECT_DIR, "runtimes")])
+    run_command(["ninja", "-j%d" % args.jobs, "install"])
 
     return 0
 
 
+def cmake_version() -> tuple[int, ...]:
+    """Return the (major, minor) version of the cmake in PATH."""
+    # The first line reads e.g. "cmake version 3.25.1" or "... 3.28.0-rc1".
+    output = subprocess.check_output(["cmake", "--version"], text=True)
+    version = output.split()[2].split("-")[0]
+    return tuple(int(v) for v in version.split(".")[:2])
+
+
+def cmake_command(build_dir: str, fresh: bool) -> list[str]:
+    """Return the cmake command configuring build_dir.
+
+    With fresh, no entries of an existing CMakeCache.txt survive, while the
+    rest of the build directory is kept for ninja to build incrementally.
+    """
+    if not fresh:
+        return ["cmake"]
+    if cmake_version() >= (3, 24):
+        return ["cmake", "--fresh"]
+    # --fresh is new in CMake 3.24; drop the cache by hand before that.
+    try:
+        os.remove(join(build_dir, "CMakeCache.txt"))
+    except FileNotFoundError:
+        pass
+    return ["cmake"]
+
+
+def available_cpus() -> int:
+    """Return how many CPUs this process may run on."""
+    # Unlike os.cpu_count(), this honors the affinity mask a CI runner or
+    # container may restrict the build to.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def run_command(command: list[str]) -> None:
-    if sys.platform == "win32":
-        _, vs_dir = detect_visual_studio()
-        script_path = join(vs_dir, "VC/Auxiliary/Build/vcvarsall.bat")
-        command = [f'"{script_path}"', "amd64", "&&"] + command
-    cmd = " ".join(command)
-    print("Running:", cmd)
-    subprocess.call(cmd, shell=True)
+    print("Running:", " ".join(command))
+    # No shell is needed now that the vcvarsall environment is loaded up front.
+    subprocess.run(command, check=True)
 
 
-def detect_visual_studio() -> tuple[str, str]:
-    """Return best available version of Visual Studio."""
-    # VS versions are listed in descending order of priority (highest first).
-    # The first version is assumed by this script to be the one that is packaged,
-    # which makes a difference for the arm64 runtime.
-    MSVS_VERSIONS = collections.OrderedDict(
-        [
-            ("2022", "17.0"),  # Default and packaged version of Visual Studio.
-            ("2019", "16.0"),
-            ("2017", "15.0"),
-        ]
+def load_visual_studio_env() -> None:
+    """Run vcvarsall.bat once and import the environment it sets up."""
+    _, vs_dir = detect_visual_studio()
+    script_path = join(vs_dir, "VC/Auxiliary/Build/vcvarsall.bat")
+    output = subprocess.check_output(
+        f'"{script_path}" amd64 && set', shell=True, text=True
     )
+    for line in output.splitlines():
+        key, sep, value = line.partition("=")
+        if key and sep:
+            os.environ[key] = value
+
 
-    supported_versions = list(MSVS_VERSIONS.keys())
+@functools.lru_cache(maxsize=1)
+def detect_visual_studio() -> tuple[str, str]:
+    """Return best available version of Visual Studio."""
+    installed = _vswhere_installations()
 
-    for version in supported_versions:
+    for version in MSVS_VERSIONS:
         # Checking vs%s_install environment variables.
         # For example, vs2019_install could have the value
         # "C:\Program Files (x86)\Microsoft Visual Studio\2019\Community".
@@ -135,17 +256,17 @@ def detect_visual_studio() -> tuple[str, str]:
         if path and exists(path):
             return version, path
 
+        if installed is not None:
+            # vswhere knows every installation, so there's nothing to probe.
+            path = installed.get(version)
+            if path:
+                os.environ["vs%s_install" % version] = path
+                return version, path
+            continue
+
         # Detecting VS under possible paths.
-        dirs = ["%ProgramFiles%", "%ProgramFiles(x86)%"]
-        editions = [
-            "Enterprise",
-            "Professional",
-            "Community",
-            "Preview",
-            "BuildTools",
-        ]
-        for dir in dirs:
-            for edition in editions:
+        for dir in MSVS_INSTALL_ROOTS:
+            for edition in MSVS_EDITIONS:
                 path = expandvars(
                     dir + "/Microsoft Visual Studio/%s/%s" % (version, edition)
                 )
@@ -160,18 +281,51 @@ def detect_visual_studio() -> tuple[str, str]:
     )
 
 
+def _vswhere_installations() -> Optional[dict[str, str]]:
+    """Return {version: path} of the usable installs vswhere.exe reports.
+
+    Of several installs of one version, the edition listed first in
+    MSVS_EDITIONS wins. Returns None if vswhere.exe, which ships with VS 2017
+    and later, is missing.
+    """
+    vswhere = expandvars(
+        "%ProgramFiles(x86)%/Microsoft Visual Studio/Installer/vswhere.exe"
+    )
+    if not exists(vswhere):
+        return None
+    # -products * includes Build Tools installs, -prerelease the Previews.
+    command = [vswhere, "-all", "-prerelease", "-products", "*"]
+    output = subprocess.check_output(command + ["-format", "json", "-utf8"])
+    years = {v.split(".")[0]: k for k, v in MSVS_VERSIONS.items()}
+    found = {}
+    for instance in json.loads(output):
+        year = years.get(instance["installationVersion"].split(".")[0])
+        # -all also lists partial and broken installs.
+        if not year or instance.get("isComplete") is False:
+            continue
+        if instance.get("isLaunchable") is False:
+            continue
+        path = instance["installationPath"]
+        if not exists(join(path, "VC/Auxiliary/Build/vcvarsall.bat")):
+            # No C++ tools in this install.
+            continue
+        if instance.get("isPrerelease"):
+            edition = "Preview"
+        else:
+            # For example "Microsoft.VisualStudio.Product.Community".
+            edition = instance.get("productId", "").rsplit(".", 1)[-1]
+        if edition in MSVS_EDITIONS:
+            rank = MSVS_EDITIONS.index(edition)
+        else:
+            rank = len(MSVS_EDITIONS)
+        if year not in found or rank < found[year][0]:
+            found[year] = (rank, path)
+    return {year: path for year, (_, path) in found.items()}
+
+
 if __name__ == "__main__":
-    # Don't buffer stdout, so that print statements are immediately flushed.
-    # LLVM tests print output without newlines, so with buffering they won't be
-    # immediately printed.
-    major, _, _, _, _ = sys.version_info
-    if major == 3:
-        # Python3 only allows unbuffered output for binary streams. This
-        # workaround comes from https://stackoverflow.com/a/181654/4052492.
-        sys.stdout = io.TextIOWrapper(
-            open(sys.stdout.fileno(), "wb", 0), write_through=True
-        )
-    else:
-        sys.stdout = os.fdopen(sys.stdout.fileno(), "w", 0)
+    # Flush every line, so that print statements show up in order with the
+    # output of the commands they announce, even when stdout is a pipe.
+    sys.stdout.reconfigure(line_buffering=True)
 
     sys.exit(main())
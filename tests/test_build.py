@@ -0,0 +1,27 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import build  # noqa: E402
+
+
+class MemberPathTest(unittest.TestCase):
+    OUTPUT_DIR = os.path.normpath("/tmp/out")
+
+    def test_relative_names(self):
+        for name in ("a/b", "./a/b", "a\\b", "a/b/"):
+            self.assertEqual(
+                build._member_path(self.OUTPUT_DIR, name),
+                os.path.join(self.OUTPUT_DIR, "a", "b"),
+            )
+
+    def test_unsafe_names(self):
+        for name in ("/etc/x", "\\etc\\x", "C:/x", "C:x", "../x", "a/../../x"):
+            with self.assertRaises(ValueError, msg=name):
+                build._member_path(self.OUTPUT_DIR, name)
+
+
+if __name__ == "__main__":
+    unittest.main()